@@ -1,17 +1,39 @@
 import os
-import re
+import asyncio
 import datetime
+import functools
+import hashlib
 import logging
-from typing import Dict, Any, Optional
-
-import requests
-from fastapi import FastAPI, Form, HTTPException
+import logging.handlers
+import queue
+import ssl
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+import certifi
+import httpx
+import orjson
+from cachetools import TLRUCache, TTLCache
+from fastapi import BackgroundTasks, FastAPI, Form, HTTPException, Request, Response
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
-from supabase import create_client, Client as SupabaseClient
-from twilio.rest import Client as TwilioClient
+from tenacity import (
+    retry, retry_if_exception_type, retry_if_result, stop_after_attempt, stop_after_delay,
+    wait_exponential, wait_random
+)
 
 # ── ENV ────────────────────────────────────────────────────────────────
-logging.basicConfig(level=logging.INFO)
+# Los handlers encolan; un hilo aparte escribe en stderr fuera del request
+log_queue: queue.SimpleQueue = queue.SimpleQueue()
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "WARNING").upper(),
+    format="%(asctime)s %(levelname)s %(name)s %(message)s",
+    handlers=[logging.handlers.QueueHandler(log_queue)]
+)
+log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+log_listener.start()
+logger = logging.getLogger(__name__)
 
 OPENAI_API_KEY      = os.getenv("OPENAI_API_KEY")
 SUPABASE_URL        = os.getenv("SUPABASE_URL")
@@ -39,8 +61,82 @@ HEADERS = {
     "Content-Type": "application/json"
 }
 
-supabase: SupabaseClient = create_client(SUPABASE_URL, SUPABASE_KEY)
-twilio_client: TwilioClient = TwilioClient(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+AEROAPI_BASE = "https://aeroapi.flightaware.com/aeroapi"
+OPENAI_BASE  = "https://api.openai.com"
+TWILIO_MESSAGES_URL = f"https://api.twilio.com/2010-04-01/Accounts/{TWILIO_ACCOUNT_SID}/Messages.json"
+
+# Un solo SSLContext (carga del bundle de CAs) compartido por los cuatro clientes:
+# cada AsyncClient crearía el suyo al importar, lo que pesa en el arranque en frío
+ssl_context = ssl.create_default_context(cafile=certifi.where())
+
+def pooled_transport() -> httpx.AsyncHTTPTransport:
+    # HTTP/2 + keep-alive; retries=2 reintenta solo fallos de conexión (nunca un request ya enviado)
+    return httpx.AsyncHTTPTransport(
+        http2=True,
+        verify=ssl_context,
+        retries=2,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=60.0)
+    )
+
+# Cliente PostgREST de Supabase: async y con orjson, sin el wrapper sync de supabase-py
+supabase_client = httpx.AsyncClient(
+    base_url=f"{SUPABASE_URL}/rest/v1",
+    headers={
+        "apikey": SUPABASE_KEY,
+        "Authorization": f"Bearer {SUPABASE_KEY}",
+        "Content-Type": "application/json"
+    },
+    transport=pooled_transport(),
+    timeout=httpx.Timeout(10.0, connect=5.0)
+)
+# Red/HTTP (incluye 4xx/5xx de PostgREST vía raise_for_status) o JSON inválido
+SUPABASE_ERRORS = (httpx.HTTPError, ValueError)
+TRIP_COLUMNS = (
+    "id,client_name,flight_number,origin_iata,destination_iata,"
+    "departure_date,status,passenger_description"
+)
+# Cliente Twilio: REST directo sobre el mismo tipo de pool async que el resto
+twilio_client = httpx.AsyncClient(
+    auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN),
+    transport=pooled_transport(),
+    timeout=httpx.Timeout(10.0, connect=5.0)
+)
+# Cliente AeroAPI compartido: keep-alive + HTTP/2 en lugar de una conexión por consulta
+aeroapi_client = httpx.AsyncClient(
+    base_url=AEROAPI_BASE,
+    headers={"x-api-key": AEROAPI_KEY or "", "Accept": "application/json"},
+    transport=pooled_transport(),
+    timeout=httpx.Timeout(connect=2.0, read=8.0, write=2.0, pool=1.0)
+)
+# Cliente OpenAI compartido: evita un handshake TLS por completion
+openai_client = httpx.AsyncClient(
+    base_url=OPENAI_BASE,
+    headers=HEADERS,
+    transport=pooled_transport(),
+    timeout=httpx.Timeout(connect=3.0, read=25.0, write=10.0, pool=5.0)
+)
+# Respuestas de AeroAPI por (vuelo, día UTC) con TTL por entrada según el estado
+# (ver aeroapi_ttl): el valor es (respuesta, segundos de vida)
+aeroapi_cache: TLRUCache = TLRUCache(maxsize=5000, ttu=lambda _key, value, now: now + value[1])
+aeroapi_inflight: Dict[Tuple[str, str], asyncio.Task] = {}
+# Circuit breaker: tras AEROAPI_BREAKER_FAILS errores seguidos, AeroAPI queda "abierto"
+# AEROAPI_BREAKER_RESET segundos y respondemos al instante sin consultarlo
+AEROAPI_BREAKER_FAILS = 5
+AEROAPI_BREAKER_RESET = 30.0
+aeroapi_breaker: Dict[str, float] = {"failures": 0, "open_until": 0.0}
+# La consulta especulativa espera esto antes de salir: si la RPC encuentra el viaje antes,
+# se cancela sin haber llegado a AeroAPI (cada consulta se cobra)
+AEROAPI_SPECULATION_DELAY = 0.25
+# Viaje asociado a cada teléfono; solo cambia al crear o asociar un viaje
+trip_cache: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+# Respuestas de OpenAI por (modelo, system, user): las preguntas se repiten entre usuarios
+openai_cache: TTLCache = TTLCache(maxsize=2000, ttl=3600)
+openai_inflight: Dict[Tuple[str, str, str], asyncio.Task] = {}
+# Filas de "conversations" pendientes de insertar; las vacía conversation_flusher
+CONVERSATION_BATCH_SIZE    = 50
+CONVERSATION_FLUSH_SECONDS = 0.5
+CONVERSATION_QUEUE_MAX     = 10_000
+conversation_queue: "asyncio.Queue[Optional[Dict[str, Any]]]" = asyncio.Queue(maxsize=CONVERSATION_QUEUE_MAX)
 
 # ── Pydantic models ────────────────────────────────────────────────────
 class ResearchRequest(BaseModel):
@@ -49,266 +145,481 @@ class ResearchRequest(BaseModel):
 class ResearchResponse(BaseModel):
     answer: str
 
-class OpenAIResponse(BaseModel):
-    reply: str
-
 # ── UTILIDADES ─────────────────────────────────────────────────────────
+# Prefijos de pregunta anclados al inicio del mensaje (ya en minúsculas)
+RESEARCH_PREFIXES = ("qué", "cómo", "dónde", "cuándo", "por qué", "cual")
+
+async def single_flight(inflight: Dict[Any, asyncio.Task], key: Any,
+                        factory: Callable[[], Awaitable[Any]]) -> Any:
+    # Todas las llamadas concurrentes con la misma clave esperan UNA tarea compartida y reciben
+    # su resultado o su excepción; la entrada se borra cuando esa tarea termina.
+    task = inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(factory())
+        inflight[key] = task
+
+        def _done(t: asyncio.Task) -> None:
+            if inflight.get(key) is t:
+                del inflight[key]
+            if not t.cancelled():
+                t.exception()  # marca la excepción como leída aunque nadie quede esperando
+
+        task.add_done_callback(_done)
+    # shield: cancelar a un caller (p.ej. la consulta especulativa) no cancela a los demás
+    return await asyncio.shield(task)
+
 def normalise_phone(raw: str) -> str:
     return raw.split(":", 1)[1] if raw.startswith("whatsapp:") else raw
 
 def validate_phone(phone: str) -> bool:
-    pattern = re.compile(r"^\+\d{9,15}$")
-    return bool(pattern.match(phone))
-
-def detect_flight_pattern(text: str) -> Optional[str]:
-    lo = text.strip().upper()
-    match = re.fullmatch(r"^([A-Z]{2}\d{3,4})$", lo)
-    return match.group(1) if match else None
-
-def is_research_query(text: str) -> bool:
-    lo = text.strip().lower()
-    if detect_flight_pattern(text):
-        return False
-    if "vuelo" in lo:
-        return False
-    palabras_inicio = ("qué", "cómo", "dónde", "cuándo", "por qué", "cual")
-    return ("?" in lo) or lo.startswith(palabras_inicio)
-
-def fetch_flight_status_from_aeroapi(flight_number: str) -> str:
-    hoy_utc = datetime.datetime.utcnow().date()
-    manana_utc = hoy_utc + datetime.timedelta(days=1)
-    start_iso = f"{hoy_utc.isoformat()}T00:00:00Z"
-    end_iso   = f"{manana_utc.isoformat()}T00:00:00Z"
+    # "+" y 9-15 dígitos ASCII; isascii evita que isdigit acepte dígitos Unicode
+    return 10 <= len(phone) <= 16 and phone[0] == "+" and phone.isascii() and phone[1:].isdigit()
+
+def flight_code(text: str) -> Optional[str]:
+    # Dos letras y 3-4 dígitos (ej. AR1234), sin pasar por el motor de regex
+    code = text.upper()
+    if 5 <= len(code) <= 6 and code.isascii() and code[:2].isalpha() and code[2:].isdigit():
+        return code
+    return None
+
+AEROAPI_TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+@functools.lru_cache(maxsize=1)
+def utc_day_window(day_bucket: int) -> Tuple[str, str, str]:
+    # (hoy, inicio, fin) en UTC para el día epoch `time.time() // 86400`;
+    # se construye una vez por día y el resto de llamadas es un hit de caché
+    hoy = datetime.date(1970, 1, 1) + datetime.timedelta(days=day_bucket)
+    return (hoy.isoformat(), *day_window(hoy))
+
+def day_window(day: datetime.date) -> Tuple[str, str]:
+    # [00:00, 00:00 del día siguiente) en UTC, en el formato con "Z" que espera AeroAPI
+    start = datetime.datetime.combine(day, datetime.time.min, tzinfo=datetime.timezone.utc)
+    end = start + datetime.timedelta(days=1)
+    return start.strftime(AEROAPI_TIME_FORMAT), end.strftime(AEROAPI_TIME_FORMAT)
+
+def today_window() -> Tuple[str, str, str]:
+    return utc_day_window(int(time.time() // 86400))
+
+def classify(text: str) -> Tuple[str, Optional[str]]:
+    # Una sola pasada: ("flight", código) | ("research", None) | ("chat", None).
+    # Un código de vuelo nunca tiene "?" ni prefijo de pregunta, así que el orden no cambia nada.
+    limpio = text.strip()
+    code = flight_code(limpio)
+    if code:
+        return "flight", code
+    lo = limpio.lower()
+    if "vuelo" not in lo and ("?" in lo or lo.startswith(RESEARCH_PREFIXES)):
+        return "research", None
+    return "chat", None
+
+@functools.lru_cache(maxsize=1024)
+def format_departure_utc(iso: str) -> str:
+    try:
+        dt = datetime.datetime.fromisoformat(iso.replace("Z", "+00:00"))
+    except ValueError:
+        return iso
+    return dt.strftime("%Y-%m-%d %H:%M UTC")
+
+AEROAPI_NEGATIVE_TTL = 60
+
+def aeroapi_ttl(estado: str) -> int:
+    # Cuanto más "cerrado" el estado, más tiempo puede vivir en caché
+    lo = estado.lower()
+    if any(s in lo for s in ("arrived", "landed", "cancel", "diverted")):
+        return 3600
+    if "en route" in lo:
+        return 120
+    if "scheduled" in lo:
+        return 900
+    return 60
+
+async def query_aeroapi(flight_number: str, start_iso: str, end_iso: str) -> Tuple[str, int]:
+    resp = await aeroapi_client.get(f"/flights/{flight_number}", params={"start": start_iso, "end": end_iso})
+    resp.raise_for_status()
+    data = orjson.loads(resp.content)
+    # AeroAPI puede mandar nulls o tipos inesperados: cualquier forma rara es un ValueError
+    if not isinstance(data, dict):
+        raise ValueError("respuesta de AeroAPI inesperada")
+    vuelos = data.get("flights") or []
+    if not isinstance(vuelos, list):
+        raise ValueError("respuesta de AeroAPI inesperada")
+    if not vuelos:
+        return (
+            f"No hay datos disponibles para el vuelo {flight_number} en las últimas 24 horas.",
+            AEROAPI_NEGATIVE_TTL
+        )
+    vuelo = vuelos[0]
+    if not isinstance(vuelo, dict):
+        raise ValueError("respuesta de AeroAPI inesperada")
+    estado = str(vuelo.get("status") or "desconocido")
+    dep = vuelo.get("departure") or {}
+    dep_sched = dep.get("scheduled") if isinstance(dep, dict) else None
+    dep_sched = format_departure_utc(dep_sched) if isinstance(dep_sched, str) and dep_sched else ""
+    answer = f"Estado del vuelo {flight_number}: {estado}.\nHora prevista de salida (UTC): {dep_sched}."
+    return answer, aeroapi_ttl(estado)
+
+async def fetch_flight_status_from_aeroapi(flight_number: str) -> str:
+    # El código va en el path de la URL: solo aceptamos el formato ya validado (ej. AR1234)
+    if flight_code(flight_number) != flight_number:
+        return f"El número de vuelo {flight_number} no es válido."
+    unavailable = f"No pude conectarme a AeroAPI. Estado estimado del vuelo {flight_number}: (desconocido)."
     if not AEROAPI_KEY:
-        return f"No pude conectarme a AeroAPI. Estado estimado del vuelo {flight_number}: (desconocido)."
-    url = f"https://aeroapi.flightaware.com/aeroapi/flights/{flight_number}?start={start_iso}&end={end_iso}"
-    headers = {"x-api-key": AEROAPI_KEY, "Accept": "application/json"}
+        return unavailable
+    hoy, start_iso, end_iso = today_window()
+    key = (flight_number, hoy)
+    # La caché se sirve aunque el circuit esté abierto; el breaker solo corta los misses
+    cached = aeroapi_cache.get(key)
+    if cached is not None:
+        return cached[0]
+    if time.monotonic() < aeroapi_breaker["open_until"]:
+        return unavailable
+    # Single-flight: las consultas concurrentes del mismo vuelo comparten una sola llamada
+    return await single_flight(
+        aeroapi_inflight, key, lambda: refresh_flight_status(flight_number, key, start_iso, end_iso)
+    )
+
+async def refresh_flight_status(flight_number: str, key: Tuple[str, str], start_iso: str, end_iso: str) -> str:
     try:
-        resp = requests.get(url, headers=headers, timeout=10)
-        resp.raise_for_status()
-        data = resp.json()
-        vuelos = data.get("flights", [])
-        if not vuelos:
-            return f"No hay datos disponibles para el vuelo {flight_number} en las últimas 24 horas."
-        vuelo = vuelos[0]
-        estado = vuelo.get("status", "desconocido")
-        dep_sched = vuelo.get("departure", {}).get("scheduled", "")
-        if dep_sched:
-            try:
-                dt = datetime.datetime.fromisoformat(dep_sched.rstrip("Z"))
-                dep_sched = dt.strftime("%Y-%m-%d %H:%M UTC")
-            except:
-                pass
-        return f"Estado del vuelo {flight_number}: {estado}.\nHora prevista de salida (UTC): {dep_sched}."
-    except Exception as e:
-        logging.error(f"AeroAPI error: {e}")
+        answer, ttl = await query_aeroapi(flight_number, start_iso, end_iso)
+    except (httpx.HTTPError, ValueError) as e:
+        logger.warning("AeroAPI error flight=%s", flight_number, exc_info=True)
+        # Un 4xx (vuelo inexistente, etc.) no indica caída de AeroAPI: no cuenta
+        if not (isinstance(e, httpx.HTTPStatusError) and e.response.status_code < 500):
+            aeroapi_breaker["failures"] += 1
+        if aeroapi_breaker["failures"] >= AEROAPI_BREAKER_FAILS:
+            aeroapi_breaker["failures"] = 0
+            aeroapi_breaker["open_until"] = time.monotonic() + AEROAPI_BREAKER_RESET
+            logger.error("AeroAPI circuit abierto por %.0fs", AEROAPI_BREAKER_RESET)
         return f"Error al consultar AeroAPI: {e}"
+    aeroapi_breaker["failures"] = 0
+    aeroapi_cache[key] = (answer, ttl)
+    return answer
 
-def get_user_trip(phone_number: str) -> Dict[str, Any]:
+async def get_user_trip(phone_number: str) -> Dict[str, Any]:
     phone = normalise_phone(phone_number)
     try:
-        resp = supabase.table("trips") \
-            .select(
-                "id, client_name, flight_number, origin_iata, destination_iata,"
-                " departure_date, status, metadata, passenger_description"
-            ).eq("whatsapp", phone).single().execute()
-    except Exception as e:
-        logging.error(f"Supabase get_user_trip error: {e}")
+        resp = await supabase_client.get(
+            "/trips",
+            params={
+                "select": TRIP_COLUMNS,
+                "whatsapp": f"eq.{phone}",
+                # Con varios viajes por número, siempre el más reciente (mismo orden que la RPC)
+                "order": "departure_date.desc,id.desc",
+                "limit": 1
+            }
+        )
+        resp.raise_for_status()
+        rows = orjson.loads(resp.content)
+    except SUPABASE_ERRORS as e:
+        logger.error("Supabase get_user_trip error: %s", e)
         return {"error": f"Error Supabase: {e}"}
-    data = resp.data or {}
-    if not data:
+    if not rows:
         return {"error": "No se encontró ningún viaje para tu número."}
-    dep = data.get("departure_date")
-    if isinstance(dep, (datetime.date, datetime.datetime)):
-        data["departure_date"] = dep.isoformat()
-    return data
+    return rows[0]
+
+def render_system_prompt(trip: Dict[str, Any]) -> str:
+    descripcion = trip.get("passenger_description") or ""
+    perfil = f"Perfil: {descripcion}\n" if descripcion else ""
+    return (
+        f"{SYSTEM_PROMPT}\n"
+        f"Eres el asistente de {trip['client_name']}.\n"
+        f"{perfil}"
+        f"Vuelo {trip['flight_number']} de {trip['origin_iata']} "
+        f"a {trip['destination_iata']}, programado {trip['departure_date']}. "
+        f"Estado actual: {trip['status']}."
+    )
 
-def find_today_trip_by_flight(flight_number: str) -> Optional[Dict[str, Any]]:
-    hoy = datetime.datetime.utcnow().date().isoformat()
-    try:
-        resp = supabase.table("trips") \
-            .select(
-                "id, client_name, flight_number, origin_iata, destination_iata,"
-                " departure_date, status, metadata, whatsapp"
-            ) \
-            .eq("flight_number", flight_number) \
-            .eq("departure_date", hoy) \
-            .single().execute()
-    except Exception as e:
-        logging.error(f"Supabase find_today_trip_by_flight error: {e}")
-        return None
-    data = resp.data or {}
-    return data if data else None
-
-def associate_phone_to_trip(trip_id: str, new_phone: str) -> bool:
-    try:
-        supabase.table("trips").update({"whatsapp": new_phone}).eq("id", trip_id).execute()
-        return True
-    except Exception as e:
-        logging.error(f"Supabase associate_phone_to_trip error: {e}")
-        return False
+def cache_trip(phone: str, trip: Dict[str, Any]) -> Dict[str, Any]:
+    # El prompt de sistema se renderiza una vez por entrada de caché, no por mensaje
+    trip["system_prompt"] = render_system_prompt(trip)
+    trip_cache[phone] = trip
+    return trip
 
-def insert_conversation_record(whatsapp: str, role: str, message: str, trip_id: Optional[str]) -> None:
+async def load_user_trip(phone_number: str) -> Dict[str, Any]:
+    phone = normalise_phone(phone_number)
+    cached = trip_cache.get(phone)
+    if cached is not None:
+        return cached
+    trip = await get_user_trip(phone)
+    if "error" not in trip:
+        cache_trip(phone, trip)
+    return trip
+
+async def lookup_or_associate_trip(phone: str, flight_number: str) -> Optional[Dict[str, Any]]:
+    # Una sola RPC (ver supabase/migrations): viaje del teléfono o, si no tiene,
+    # el viaje de hoy de ese vuelo ya asociado al teléfono. None si no hay ninguno.
     try:
-        supabase.table("conversations").insert({
-            "whatsapp": whatsapp,
-            "role": role,
-            "message": message,
-            "trip_id": trip_id
-        }).execute()
-    except Exception as e:
-        logging.error(f"Supabase insert_conversation_record error: {e}")
-
-def openai_chat(messages: list) -> str:
+        resp = await supabase_client.post(
+            "/rpc/lookup_or_associate_trip",
+            params={"select": TRIP_COLUMNS},
+            content=orjson.dumps({
+                "p_phone": phone,
+                "p_flight": flight_number,
+                "p_date": today_window()[0]
+            })
+        )
+        resp.raise_for_status()
+        rows = orjson.loads(resp.content)
+    except SUPABASE_ERRORS as e:
+        logger.error("Supabase lookup_or_associate_trip error: %s", e)
+        return {"error": f"Error Supabase: {e}"}
+    return rows[0] if rows else None
+
+async def load_or_associate_trip(phone_number: str, flight_number: str) -> Optional[Dict[str, Any]]:
+    phone = normalise_phone(phone_number)
+    cached = trip_cache.get(phone)
+    if cached is not None:
+        return cached
+    trip = await lookup_or_associate_trip(phone, flight_number)
+    if trip and "error" not in trip:
+        cache_trip(phone, trip)
+    return trip
+
+async def insert_conversation_rows(rows: list) -> None:
+    # Un solo insert por lote: PostgREST acepta arrays para bulk insert
     try:
-        logging.info("Llamando a OpenAI con payload: %s", messages)
-        resp = requests.post(
-            "https://api.openai.com/v1/chat/completions",
-            json={"model": "gpt-4o-mini", "messages": messages},
-            headers=HEADERS,
-            timeout=15
+        resp = await supabase_client.post(
+            "/conversations", headers={"Prefer": "return=minimal"}, content=orjson.dumps(rows)
         )
         resp.raise_for_status()
-        text = resp.json()["choices"][0]["message"]["content"]
-        logging.info("Respuesta de OpenAI: %s", text)
-        return text
-    except Exception as e:
-        logging.error(f"OpenAI error: {e}")
-        return "Lo siento, algo falló al conectar con OpenAI."
+    except SUPABASE_ERRORS as e:
+        logger.error("Supabase insert_conversation_rows error (%d filas): %s", len(rows), e)
+
+def enqueue_conversation_turn(whatsapp: str, user_message: str, answer: str, trip_id: Optional[str]) -> None:
+    # Con la cola llena (Supabase caído o lento) descartamos el turno entero en vez de
+    # frenar la respuesta; se chequea antes para no dejar la fila del usuario sin su respuesta
+    if CONVERSATION_QUEUE_MAX - conversation_queue.qsize() < 2:
+        logger.error("Cola de conversaciones llena: se descarta el turno de %s", whatsapp)
+        return
+    conversation_queue.put_nowait(
+        {"whatsapp": whatsapp, "role": "user",      "message": user_message, "trip_id": trip_id}
+    )
+    conversation_queue.put_nowait(
+        {"whatsapp": whatsapp, "role": "assistant", "message": answer,       "trip_id": trip_id}
+    )
 
-# ── FASTAPI ────────────────────────────────────────────────────────────
-app = FastAPI()
+async def conversation_flusher() -> None:
+    # Junta filas hasta CONVERSATION_BATCH_SIZE o CONVERSATION_FLUSH_SECONDS y las inserta juntas.
+    # None en la cola es la señal de apagado: se inserta lo pendiente y se sale.
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        row = await conversation_queue.get()
+        if row is None:
+            break
+        batch = [row]
+        deadline = loop.time() + CONVERSATION_FLUSH_SECONDS
+        while len(batch) < CONVERSATION_BATCH_SIZE:
+            try:
+                row = await asyncio.wait_for(conversation_queue.get(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                break
+            if row is None:
+                stopping = True
+                break
+            batch.append(row)
+        # Un error inesperado no puede matar la única tarea que escribe conversaciones
+        try:
+            await insert_conversation_rows(batch)
+        except Exception:
+            logger.exception("conversation_flusher: error insertando %d filas", len(batch))
 
-@app.post("/research", response_model=ResearchResponse)
-def research(req: ResearchRequest):
+async def send_whatsapp(to: str, body: str) -> None:
+    try:
+        resp = await twilio_client.post(
+            TWILIO_MESSAGES_URL, data={"From": TWILIO_WHATSAPP, "To": to, "Body": body}
+        )
+        resp.raise_for_status()
+    except httpx.HTTPError as e:
+        logger.error("Twilio send error: %s", e)
+
+async def deliver_reply(to: str, phone: str, user_message: str, answer: str, trip_id: Optional[str]) -> None:
+    # Corre como BackgroundTask, después de responder al webhook de Twilio.
+    # Las filas de la conversación van a la cola; conversation_flusher las inserta por lotes
+    enqueue_conversation_turn(phone, user_message, answer, trip_id)
+    await send_whatsapp(to, answer)
+
+OPENAI_MODEL = "gpt-4o-mini"
+RESEARCH_SYSTEM_PROMPT = "Eres un asistente de viajes experto."
+OPENAI_RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+# El POST no es idempotente: solo reintentamos fallos en los que la petición no llegó a procesarse.
+# Un ReadTimeout puede significar que OpenAI ya está generando (y cobrando) la respuesta.
+OPENAI_RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout, httpx.RemoteProtocolError)
+# Red/HTTP o respuesta con forma inesperada (JSON inválido, sin "choices")
+OPENAI_ERRORS = (httpx.HTTPError, KeyError, IndexError, ValueError)
+
+@retry(
+    # Tope de tiempo además de intentos: el webhook no puede quedar colgado detrás de los reintentos
+    stop=stop_after_attempt(3) | stop_after_delay(12),
+    # 0.5s, 1s, 2s... (tope 8s) + hasta 1s de jitter; API estable en todas las versiones de tenacity
+    wait=wait_exponential(multiplier=0.5, max=8) + wait_random(0, 1),
+    retry=(
+        retry_if_exception_type(OPENAI_RETRYABLE_ERRORS)
+        | retry_if_result(lambda r: r.status_code in OPENAI_RETRYABLE_STATUS)
+    ),
+    # Agotados los reintentos, devolvemos la última respuesta para que el caller decida
+    retry_error_callback=lambda state: state.outcome.result()
+)
+async def post_chat_completion(payload: Dict[str, Any]) -> httpx.Response:
+    return await openai_client.post("/v1/chat/completions", content=orjson.dumps(payload))
+
+async def chat_completion(system: str, user: str) -> str:
+    # temperature=0 hace la respuesta reproducible, así que (modelo, system, user) es una clave válida
+    key = (OPENAI_MODEL, system, user)
+    cached = openai_cache.get(key)
+    if cached is not None:
+        return cached
+    # Single-flight: la misma pregunta en vuelo desde varios webhooks comparte una sola llamada
+    # (y su error: nadie reintenta por su cuenta detrás del primero)
+    return await single_flight(openai_inflight, key, lambda: request_chat_completion(key, system, user))
+
+async def request_chat_completion(key: Tuple[str, str, str], system: str, user: str) -> str:
     payload = {
-        "model": "gpt-4o-mini",
+        "model": OPENAI_MODEL,
+        "temperature": 0,
         "messages": [
-            {"role": "system", "content": "Eres un asistente de viajes experto."},
-            {"role": "user",   "content": req.question}
+            {"role": "system", "content": system},
+            {"role": "user",   "content": user}
         ]
     }
-    resp = requests.post(
-        "https://api.openai.com/v1/chat/completions",
-        json=payload,
-        headers=HEADERS,
-        timeout=15
-    )
-    if resp.status_code != 200:
-        raise HTTPException(resp.status_code, resp.text)
-    return {"answer": resp.json()["choices"][0]["message"]["content"]}
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Llamando a OpenAI con payload: %s", payload)
+    resp = await post_chat_completion(payload)
+    resp.raise_for_status()
+    text = orjson.loads(resp.content)["choices"][0]["message"]["content"]
+    openai_cache[key] = text
+    return text
+
+async def openai_chat(system: str, user: str) -> str:
+    try:
+        text = await chat_completion(system, user)
+    except OPENAI_ERRORS as e:
+        logger.error("OpenAI error: %s", e)
+        return "Lo siento, algo falló al conectar con OpenAI."
+    logger.debug("Respuesta de OpenAI: %s", text)
+    return text
 
-@app.post("/webhook", response_model=OpenAIResponse)
-def whatsapp_webhook(From: str = Form(...), Body: str = Form(...)):
-    phone = normalise_phone(From)
-    if not validate_phone(phone):
-        twilio_client.messages.create(
-            from_=TWILIO_WHATSAPP,
-            to=From,
-            body=(
-                "Disculpas, el formato de tu número no es válido. "
-                "Asegúrate de estar enviando desde tu WhatsApp con código de país "
-                "(ej: +54911XXXXXXX)."
-            )
-        )
-        return {"reply": "Número inválido"}
+# ── FASTAPI ────────────────────────────────────────────────────────────
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    flusher = asyncio.create_task(conversation_flusher())
+    try:
+        yield
+    finally:
+        try:
+            if not flusher.done():
+                await conversation_queue.put(None)
+            await flusher
+        except Exception:
+            logger.exception("conversation_flusher terminó con error")
+        finally:
+            await aeroapi_client.aclose()
+            await openai_client.aclose()
+            await twilio_client.aclose()
+            await supabase_client.aclose()
+            log_listener.stop()
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+
+async def run_research(question: str) -> str:
+    try:
+        return await chat_completion(RESEARCH_SYSTEM_PROMPT, question)
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(e.response.status_code, e.response.text)
 
-    # 1) Intentar obtener el viaje del usuario
-    trip = get_user_trip(From)
-    trip_id = trip.get("id") if "error" not in trip else None
+async def answer_research(question: str) -> str:
+    try:
+        return await run_research(question)
+    except (HTTPException, *OPENAI_ERRORS) as e:
+        logger.error("Research error: %s", e)
+        return "Lo siento, hubo un problema al buscar la información."
 
-    # 2) Guardar mensaje de usuario en conversations
-    insert_conversation_record(phone, "user", Body, trip_id)
+RESEARCH_CACHE_CONTROL = "public, max-age=3600, stale-while-revalidate=86400"
 
-    # 3) Si es consulta de research
-    if is_research_query(Body):
-        try:
-            r = requests.post(
-                f"https://{os.getenv('RAILWAY_STATIC_URL')}/research",
-                json={"question": Body},
-                headers={"Content-Type": "application/json"},
-                timeout=15
-            )
-            if r.status_code == 200:
-                answer = r.json().get("answer", "Lo siento, no pude obtener respuesta.")
-            else:
-                answer = "Lo siento, hubo un problema al buscar la información."
-        except Exception as e:
-            logging.error(f"Research endpoint error: {e}")
-            answer = "Lo siento, hubo un problema al buscar la información."
-
-        insert_conversation_record(phone, "assistant", answer, trip_id)
-        twilio_client.messages.create(from_=TWILIO_WHATSAPP, to=From, body=answer)
-        return {"reply": answer}
-
-    # 4) Si el usuario no tiene viaje asociado, manejamos flight_number
-    if not trip_id:
-        posible_flight = detect_flight_pattern(Body)
-        if posible_flight:
-            found = find_today_trip_by_flight(posible_flight)
-            if found:
-                exito = associate_phone_to_trip(found["id"], phone)
-                if exito:
-                    trip = {
-                        "id": found["id"],
-                        "client_name": found["client_name"],
-                        "flight_number": found["flight_number"],
-                        "origin_iata": found["origin_iata"],
-                        "destination_iata": found["destination_iata"],
-                        "departure_date": found["departure_date"],
-                        "status": found["status"],
-                        "passenger_description": found.get("passenger_description", "")
-                    }
-                    trip_id = trip["id"]
-                else:
-                    answer = (
-                        "¡Ups! Hubo un problema al asociar tu número con el vuelo. "
-                        "Por favor, inténtalo de nuevo más tarde."
-                    )
-                    insert_conversation_record(phone, "assistant", answer, None)
-                    twilio_client.messages.create(from_=TWILIO_WHATSAPP, to=From, body=answer)
-                    return {"reply": answer}
-            else:
-                answer = fetch_flight_status_from_aeroapi(posible_flight)
-                insert_conversation_record(phone, "assistant", answer, None)
-                twilio_client.messages.create(from_=TWILIO_WHATSAPP, to=From, body=answer)
-                return {"reply": answer}
-        else:
-            answer = (
-                "¡Hola! No encuentro tu reserva. "
-                "Por favor, compárteme tu número de vuelo (por ejemplo: 'AR1234') "
-                "o tu localizador para poder ayudarte."
-            )
-            insert_conversation_record(phone, "assistant", answer, None)
-            twilio_client.messages.create(from_=TWILIO_WHATSAPP, to=From, body=answer)
-            return {"reply": answer}
-
-    # 5) Usuario ya registrado (o recién asociado): llamamos a OpenAI
-    descripcion = trip.get("passenger_description", "")
-    user_ctx = f"Eres el asistente de {trip['client_name']}.\n"
-    if descripcion:
-        user_ctx += f"Perfil: {descripcion}\n"
-    user_ctx += (
-        f"Vuelo {trip['flight_number']} de {trip['origin_iata']} "
-        f"a {trip['destination_iata']}, programado {trip['departure_date']}. "
-        f"Estado actual: {trip['status']}."
-    )
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    # If-None-Match admite "*" o una lista separada por comas; la comparación es débil (ignora W/)
+    if not if_none_match:
+        return False
+    opaque = lambda tag: tag[2:] if tag.startswith("W/") else tag
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or opaque(etag) in (opaque(t) for t in tags)
 
-    messages = [
-        {"role": "system", "content": SYSTEM_PROMPT + "\n" + user_ctx},
-        {"role": "user", "content": Body}
-    ]
-    answer = openai_chat(messages)
+@app.post("/research", response_model=ResearchResponse)
+async def research(req: ResearchRequest, request: Request, response: Response):
+    # La respuesta sale de (modelo, prompt, pregunta) con temperature=0, pero OpenAI no garantiza
+    # bytes idénticos: ETag débil (misma respuesta semántica, no mismo cuerpo)
+    etag = 'W/"' + hashlib.blake2b(
+        f"{OPENAI_MODEL}|{RESEARCH_SYSTEM_PROMPT}|{req.question}".encode(), digest_size=16
+    ).hexdigest() + '"'
+    headers = {"ETag": etag, "Cache-Control": RESEARCH_CACHE_CONTROL}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    answer = await run_research(req.question)
+    response.headers.update(headers)
+    return {"answer": answer}
+
+# Un handler por tipo de mensaje; cada uno hace solo su propio I/O y devuelve (respuesta, trip_id)
+async def handle_research(phone_number: str, body: str, flight: Optional[str]) -> Tuple[str, Optional[str]]:
+    # No depende del viaje (el trip_id solo se usa al guardar la conversación),
+    # así que OpenAI y la búsqueda en Supabase corren en paralelo.
+    answer, trip = await asyncio.gather(answer_research(body), load_user_trip(phone_number))
+    return answer, (trip.get("id") if "error" not in trip else None)
+
+async def speculative_flight_status(flight_number: str) -> str:
+    await asyncio.sleep(AEROAPI_SPECULATION_DELAY)
+    return await fetch_flight_status_from_aeroapi(flight_number)
+
+async def handle_flight(phone_number: str, body: str, flight: Optional[str]) -> Tuple[str, Optional[str]]:
+    # El viaje del usuario (o la asociación al vuelo de hoy) sale de una sola RPC;
+    # en paralelo y de forma especulativa (con retraso) consultamos AeroAPI.
+    aero_task = asyncio.create_task(speculative_flight_status(flight))
+    trip = await load_or_associate_trip(phone_number, flight)
+    # Sin viaje, o si la RPC falló, el estado del vuelo sigue siendo una respuesta útil
+    if trip is None or "error" in trip:
+        return await aero_task, None
+    aero_task.cancel()
+    return await openai_chat(trip["system_prompt"], body), trip["id"]
+
+async def handle_chat(phone_number: str, body: str, flight: Optional[str]) -> Tuple[str, Optional[str]]:
+    # Sin número de vuelo: solo sirve un viaje ya asociado
+    trip = await load_user_trip(phone_number)
+    if "error" in trip:
+        return (
+            "¡Hola! No encuentro tu reserva. "
+            "Por favor, compárteme tu número de vuelo (por ejemplo: 'AR1234') "
+            "o tu localizador para poder ayudarte."
+        ), None
+    return await openai_chat(trip["system_prompt"], body), trip["id"]
+
+MESSAGE_HANDLERS = {"research": handle_research, "flight": handle_flight, "chat": handle_chat}
+
+# Sin response_model: Twilio solo mira el 2xx y el dict va directo a ORJSONResponse
+@app.post("/webhook")
+async def whatsapp_webhook(background_tasks: BackgroundTasks, From: str = Form(...), Body: str = Form(...)):
+    phone = normalise_phone(From)
+    if not validate_phone(phone):
+        background_tasks.add_task(
+            send_whatsapp,
+            From,
+            "Disculpas, el formato de tu número no es válido. "
+            "Asegúrate de estar enviando desde tu WhatsApp con código de país "
+            "(ej: +54911XXXXXXX)."
+        )
+        return {"reply": "Número inválido"}
 
-    insert_conversation_record(phone, "assistant", answer, trip_id)
-    try:
-        twilio_client.messages.create(from_=TWILIO_WHATSAPP, to=From, body=answer)
-    except Exception as e:
-        logging.error(f"Twilio send error: {e}")
-        raise HTTPException(500, f"Error al enviar WhatsApp: {e}")
+    kind, posible_flight = classify(Body)
+    answer, trip_id = await MESSAGE_HANDLERS[kind](From, Body, posible_flight)
 
+    background_tasks.add_task(deliver_reply, From, phone, Body, answer, trip_id)
     return {"reply": answer}
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=int(os.getenv("PORT", 8000)))
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", 8000)),
+        workers=int(os.getenv("WEB_CONCURRENCY", 1)),
+        loop="uvloop",
+        http="httptools"
+    )
@@ -0,0 +1,30 @@
+-- Resuelve el viaje de un número de WhatsApp en un solo round-trip:
+-- 1) el viaje ya asociado al teléfono, o
+-- 2) el viaje de hoy con ese número de vuelo todavía sin teléfono, asociándoselo.
+--    Un viaje ya reclamado por otro número nunca se reasigna: sin fila libre no devuelve nada.
+-- Devuelve 0 o 1 fila (setof para que PostgREST entregue [] si no hay viaje).
+create or replace function public.lookup_or_associate_trip(p_phone text, p_flight text, p_date date)
+returns setof public.trips
+language plpgsql
+as $$
+begin
+  return query
+    select * from public.trips where whatsapp = p_phone
+    order by departure_date desc, id desc
+    limit 1;
+  if found then
+    return;
+  end if;
+
+  return query
+    update public.trips set whatsapp = p_phone
+    where id = (
+      select id from public.trips
+      where flight_number = p_flight and departure_date = p_date and whatsapp is null
+      limit 1
+      for update
+    )
+    and whatsapp is null
+    returning *;
+end;
+$$;
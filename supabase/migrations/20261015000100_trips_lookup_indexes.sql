@@ -0,0 +1,4 @@
+-- Índices para las búsquedas del webhook sobre trips (get_user_trip y lookup_or_associate_trip).
+-- Sin ellos cada mensaje es un seq scan a medida que crece la tabla.
+create index if not exists idx_trips_whatsapp on public.trips (whatsapp);
+create index if not exists idx_trips_flight_date on public.trips (flight_number, departure_date);